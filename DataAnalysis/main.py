@@ -59,6 +59,101 @@ def dataset_from_file(filepath):
         windows = res['couples']
         return get_dataset(windows)
 
+def iter_windows_from_file(filepath, skip_snapshots=False, read_size=1 << 16):
+    # Yields the items of the 'couples' array one by one,
+    # without ever holding the whole export in memory
+    decoder = json.JSONDecoder()
+    with open(filepath) as f:
+        buf, pos, eof = '', 0, False
+
+        def fill(size=read_size):
+            nonlocal buf, pos, eof
+            chunk = f.read(size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def skip_ws():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return
+                fill()
+
+        # Find the opening bracket of the 'couples' array
+        while True:
+            idx = buf.find('"couples"', pos)
+            if idx >= 0:
+                pos = idx + len('"couples"')
+                break
+            assert not eof, "No 'couples' array in this file"
+            pos = max(pos, len(buf) - len('"couples"'))
+            fill()
+
+        for expected in ':[':
+            skip_ws()
+            assert buf[pos:pos+1] == expected, 'Malformed dataset file'
+            pos += 1
+
+        skip_ws()
+        if buf[pos:pos+1] == ']':
+            return
+
+        while True:
+            skip_ws()
+            while True:
+                try:
+                    window, end = decoder.raw_decode(buf, pos)
+                    # A number may be cut at the end of the buffer
+                    if end < len(buf) or eof:
+                        break
+                except json.JSONDecodeError:
+                    assert not eof, 'Malformed dataset file'
+                # Grow geometrically so that large snapshots are not re-parsed too often
+                fill(max(read_size, len(buf) - pos))
+            pos = end
+
+            if skip_snapshots:
+                window.pop('snapshot', None)
+            yield window
+
+            skip_ws()
+            sep = buf[pos:pos+1]
+            pos += 1
+            if sep == ']':
+                return
+            assert sep == ',', 'Malformed dataset file'
+
+def dataset_from_file_chunked(filepath, chunk_size=4096, skip_snapshots=True):
+    X_chunks, y_chunks = [], []
+    X_buf = np.empty((chunk_size, 4))
+    y_buf = np.empty(chunk_size)
+    n = 0
+
+    for w in iter_windows_from_file(filepath, skip_snapshots=skip_snapshots):
+        X_buf[n] = extract_sample(w)
+        y_buf[n] = float(w['label'])
+        n += 1
+        if n == chunk_size:
+            X_chunks.append(X_buf)
+            y_chunks.append(y_buf)
+            X_buf = np.empty((chunk_size, 4))
+            y_buf = np.empty(chunk_size)
+            n = 0
+
+    X_chunks.append(X_buf[:n])
+    y_chunks.append(y_buf[:n])
+    return np.concatenate(X_chunks), np.concatenate(y_chunks)
+
+def datasets_from_files(filepaths, chunk_size=4096, skip_snapshots=True, max_workers=None):
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    load = partial(dataset_from_file_chunked, chunk_size=chunk_size, skip_snapshots=skip_snapshots)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(load, filepaths))
+
 def dataset_from_db_user_content(user_content, data_type):
     return get_dataset(extract_windows(user_content, data_type))
 
@@ -142,10 +237,10 @@ def get_javi_remote_energy():
     return dataset_from_db(user_index=0, data_type='energy_data')
 
 def get_alexa_local_stress():
-    return dataset_from_file(DATA_FOLDER+'alexa-20180507/dataset.json')
+    return dataset_from_file_chunked(DATA_FOLDER+'alexa-20180507/dataset.json')
 
 def get_javi_local_stress():
-    return dataset_from_file(DATA_FOLDER+'javi-20180427/dataset.json')
+    return dataset_from_file_chunked(DATA_FOLDER+'javi-20180427/dataset.json')
 
 def test_signals(db_content):
 
@@ -404,6 +499,425 @@ def test_energy_model_avg(X, y, trials=1_000):
     print('avg_score_test', avg_score_test)
 
 
+###########################
+# Data Augmentation
+###########################
+
+def snapshot_signals(window):
+    s = window['snapshot']
+    gsr = np.asarray(s['gsr_samples'], dtype=float)
+    hr = np.asarray(s['hr_samples'], dtype=float)
+    return gsr, hr, s['timestamp_end'] - s['timestamp_beg']
+
+def resample_windows(flat, offsets, sizes, parents, starts, spans, n_points):
+    # Cuts [start, start+span] (fractions of the parent duration) from each parent signal
+    # stored in 'flat', stretched by linear interpolation to n_points samples
+    t = np.linspace(0.0, 1.0, n_points)
+    last = (sizes[parents] - 1)[:, None]
+    pos = (starts[:, None] + spans[:, None] * t[None, :]) * last
+    # Positions on (almost) whole samples are taken exactly, otherwise rounding errors
+    # on flat stretches of quantized signals would create spurious local maxima
+    whole = np.rint(pos)
+    pos = np.where(np.abs(pos - whole) < 1e-9, whole, pos)
+    i0 = np.minimum(pos.astype(int), last - 1)
+    frac = pos - i0
+    i0 += offsets[parents][:, None]
+    a, b = flat[i0], flat[i0 + 1]
+    return np.where(frac == 1.0, b, a + (b - a) * frac)
+
+def count_local_maxima(S, min_distance):
+    # Row-wise equivalent of Signal.computeLocalMaxima(...).count on the phone
+    no_peak = np.iinfo(np.int64).max
+    plus = ~np.signbit(np.diff(S, axis=1))
+    since_last = np.full(S.shape[0], no_peak)
+    count = np.zeros(S.shape[0])
+    for i in range(1, plus.shape[1]):
+        peak = plus[:, i-1] & ~plus[:, i] & (since_last >= min_distance)
+        since_last = np.where(peak, 1, np.where(since_last < no_peak, since_last + 1, since_last))
+        count += peak
+    return count
+
+def window_features(gsr, hr, length):
+    # Same features as ModelSample(snapshot:) for a batch of windows (one per row)
+    min_distance = np.ceil(1.0 * gsr.shape[1] / length)
+    return np.stack([
+        gsr.mean(axis=1),
+        count_local_maxima(gsr, min_distance),
+        hr.mean(axis=1),
+        np.diff(hr, axis=1).mean(axis=1)
+    ], axis=1)
+
+def augment_windows(windows, n_per_window=50, min_span=0.8, gain=0.05, batch_size=20_000, seed=None):
+    # Regenerates n_per_window overlapping sub-windows from the snapshot of each labeled window:
+    # random span in [min_span, 1] of the original duration, random offset, stretched back to
+    # the full window length (and size), with a random gain of +/- 'gain' on each signal.
+    # Returns X, y and the index of the parent window of each row (to be used as split groups).
+    # n_per_window can also be a dict {label: n}, e.g. to balance the classes.
+    rng = np.random.default_rng(seed)
+
+    parents = [i for i, w in enumerate(windows)
+               if 'snapshot' in w
+               and len(w['snapshot']['gsr_samples']) > 2
+               and len(w['snapshot']['hr_samples']) > 2]
+    assert len(parents) > 0, 'No window with snapshot data (was it loaded with skip_snapshots=True?)'
+    signals = [snapshot_signals(windows[i]) for i in parents]
+    labels = np.array([float(windows[i]['label']) for i in parents])
+
+    gsr_sizes = np.array([len(s[0]) for s in signals])
+    hr_sizes = np.array([len(s[1]) for s in signals])
+    gsr_flat = np.concatenate([s[0] for s in signals])
+    hr_flat = np.concatenate([s[1] for s in signals])
+    gsr_offsets = np.cumsum(gsr_sizes) - gsr_sizes
+    hr_offsets = np.cumsum(hr_sizes) - hr_sizes
+    lengths = np.array([s[2] for s in signals])
+
+    if isinstance(n_per_window, dict):
+        counts = np.array([n_per_window[l] for l in labels])
+    else:
+        counts = np.full(len(parents), n_per_window)
+    rows = np.repeat(np.arange(len(parents)), counts)
+
+    spans = rng.uniform(min_span, 1.0, rows.shape[0])
+    starts = rng.uniform(0.0, 1.0, rows.shape[0]) * (1.0 - spans)
+    gains = rng.uniform(1.0 - gain, 1.0 + gain, (2, rows.shape[0], 1))
+
+    # Each sub-window keeps the sample count of its parent, so that the
+    # per-sample features (hr derivative, gsr peaks distance) are unchanged
+    # with min_span=1 and gain=0. Rows are batched by parent sizes.
+    X = np.empty((rows.shape[0], 4))
+    size_keys = gsr_sizes[rows] * (hr_sizes.max() + 1) + hr_sizes[rows]
+    for key in np.unique(size_keys):
+        same_size = np.flatnonzero(size_keys == key)
+        gsr_points, hr_points = gsr_sizes[rows[same_size[0]]], hr_sizes[rows[same_size[0]]]
+        for beg in range(0, same_size.shape[0], batch_size):
+            r = same_size[beg:beg+batch_size]
+            p = rows[r]
+            gsr = resample_windows(gsr_flat, gsr_offsets, gsr_sizes, p, starts[r], spans[r], gsr_points) * gains[0][r]
+            hr = resample_windows(hr_flat, hr_offsets, hr_sizes, p, starts[r], spans[r], hr_points) * gains[1][r]
+            X[r] = window_features(gsr, hr, lengths[p])
+
+    return X, labels[rows], np.array(parents)[rows]
+
+def test_augmentation_identity(windows=None, n_windows=200, seed=None):
+    # With min_span=1 and gain=0 each sub-window is its parent, so the features
+    # stored in the windows must be reproduced exactly.
+    # Without windows, uses synthetic snapshots quantized like the sensor data (plateaus).
+    if windows is None:
+        rng = np.random.default_rng(seed)
+        windows = []
+        for _ in range(n_windows):
+            gsr = np.round(np.cumsum(rng.normal(0.0, 0.01, rng.integers(470, 490))) + 2.0, 2)
+            hr = np.round(np.cumsum(rng.normal(0.0, 0.5, rng.integers(115, 125))) + 70.0, 0)
+            f = window_features(gsr[None], hr[None], 120.0)[0]
+            windows.append({
+                'label': float(rng.random() < 0.5),
+                'sample': dict(zip(['gsrMean', 'gsrLocals', 'hrMean', 'hrMeanDerivative'], f)),
+                'snapshot': {
+                    'gsr_samples': gsr.tolist(),
+                    'hr_samples': hr.tolist(),
+                    'timestamp_beg': 0.0,
+                    'timestamp_end': 120.0
+                }
+            })
+
+    X_aug, _, parents = augment_windows(windows, n_per_window=1, min_span=1.0, gain=0.0, seed=seed)
+    X, _ = get_dataset([windows[i] for i in parents])
+    mismatches = np.sum(np.any(np.abs(X_aug - X) > 1e-9 * np.maximum(1.0, np.abs(X)), axis=1))
+    assert mismatches == 0, f'{mismatches} of {X.shape[0]} windows not reproduced'
+    return True
+
+def train_test_split_groups(X, y, groups, test_size=0.33, seed=None):
+    # Rows with the same parent window always end up on the same side
+    from sklearn.model_selection import GroupShuffleSplit
+    split = GroupShuffleSplit(n_splits=1, test_size=test_size, random_state=seed)
+    train, test = next(split.split(X, y, groups))
+    return X[train], X[test], y[train], y[test]
+
+def test_augmented_dataset(windows, n_per_window=20, seed=None, silent=False):
+    from time import perf_counter
+
+    train_idx, test_idx = train_test_split(np.arange(len(windows)), test_size=0.33, random_state=seed)
+    train_windows = [windows[i] for i in train_idx]
+    X_train, y_train = get_dataset(train_windows)
+    X_test, y_test = get_dataset([windows[i] for i in test_idx])
+
+    # Baseline: balanced by duplication
+    X_bal, y_bal = balance_dataset(X_train, y_train)
+    svm = SVC()
+    svm.fit(X_bal, y_bal)
+    p_base = svm.predict(X_test)
+
+    # Augmented: balanced by generating more sub-windows for the minority class
+    n_0, n_1 = np.sum(y_train == NOT_STRESSED), np.sum(y_train == STRESSED)
+    n_max = max(n_0, n_1)
+    counts = {
+        NOT_STRESSED: int(round(n_per_window * n_max / max(n_0, 1))),
+        STRESSED: int(round(n_per_window * n_max / max(n_1, 1)))
+    }
+
+    t = perf_counter()
+    X_aug, y_aug, _ = augment_windows(train_windows, n_per_window=counts, seed=seed)
+    elapsed = perf_counter() - t
+
+    svm = SVC()
+    svm.fit(X_aug, y_aug)
+    p_aug = svm.predict(X_test)
+
+    results = {
+        'rows_train': X_bal.shape[0],
+        'rows_train_aug': X_aug.shape[0],
+        'rows_per_minute': 60.0 * X_aug.shape[0] / elapsed,
+        'acc_test': accuracy_score(y_test, p_base),
+        'f1_test': f1_score(y_test, p_base),
+        'acc_test_aug': accuracy_score(y_test, p_aug),
+        'f1_test_aug': f1_score(y_test, p_aug),
+    }
+
+    if not silent:
+        print(results)
+
+    return results
+
+
+###########################
+# Online Learning
+###########################
+
+class OnlineModel:
+    # Random Fourier features (approximating an RBF kernel on standardized features) + linear SGD.
+    # Each call to partial_fit costs O(n_components), regardless of the history size.
+
+    def __init__(self, regression=False, n_components=300, gamma=0.25,
+                 epsilon=0.0841395, alpha=1e-4, seed=None):
+        from sklearn.kernel_approximation import RBFSampler
+        from sklearn.linear_model import SGDClassifier, SGDRegressor
+        from sklearn.preprocessing import StandardScaler
+
+        self.regression = regression
+        self.scaler = StandardScaler()
+        # gamma=0.25 is what gamma='scale' would give on 4 standardized features. The batch
+        # SVC/SVR in this file are fit on raw features, so their kernel is not the same
+        self.features = RBFSampler(gamma=gamma, n_components=n_components, random_state=seed)
+        self.features.fit(np.zeros((1, 4)))
+
+        if regression:
+            self.model = SGDRegressor(loss='epsilon_insensitive', epsilon=epsilon, alpha=alpha, random_state=seed)
+        else:
+            self.model = SGDClassifier(loss='hinge', alpha=alpha, random_state=seed)
+
+    def transform(self, X):
+        return self.features.transform(self.scaler.transform(np.atleast_2d(X)))
+
+    def partial_fit(self, X, y):
+        X, y = np.atleast_2d(X), np.atleast_1d(y)
+        self.scaler.partial_fit(X)
+        if self.regression:
+            self.model.partial_fit(self.transform(X), y)
+        else:
+            self.model.partial_fit(self.transform(X), y, classes=[NOT_STRESSED, STRESSED])
+        return self
+
+    def fit(self, X, y, epochs=5):
+        for _ in range(epochs):
+            X_e, y_e = shuffle_samples(X, y)
+            self.partial_fit(X_e, y_e)
+        return self
+
+    def predict(self, X):
+        return self.model.predict(self.transform(X))
+
+    def add_sample(self, x, y):
+        # Same as the addSample path of the apps: one new labeled window
+        return self.partial_fit(x, y)
+
+
+def make_online_stress_model(seed=None):
+    return OnlineModel(regression=False, seed=seed)
+
+def make_online_energy_model(epsilon=0.0841395, seed=None):
+    return OnlineModel(regression=True, epsilon=epsilon, seed=seed)
+
+def test_online_model(X, y, regression=False, epochs=1, seed=None, silent=False):
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.33, random_state=seed)
+
+    if regression:
+        batch = SVR()
+        batch.epsilon = 0.0841395
+        batch.C = 0.122
+        online = make_online_energy_model(seed=seed)
+        score = r2_score
+    else:
+        X_train, y_train = balance_dataset(X_train, y_train)
+        # Duplicated rows are appended at the end, which would bias the streamed SGD
+        X_train, y_train = shuffle_samples(X_train, y_train)
+        batch = SVC()
+        online = make_online_stress_model(seed=seed)
+        score = accuracy_score
+
+    batch.fit(X_train, y_train)
+
+    # Windows arrive one at a time, as they are logged by the user (single pass)
+    for i in range(X_train.shape[0]):
+        online.add_sample(X_train[i], y_train[i])
+
+    results = {
+        'score_batch': score(y_test, batch.predict(X_test)),
+        'score_online': score(y_test, online.predict(X_test)),
+    }
+
+    # Optional extra passes over the history, reported separately
+    if epochs > 1:
+        for _ in range(epochs - 1):
+            for i in range(X_train.shape[0]):
+                online.add_sample(X_train[i], y_train[i])
+        results[f'score_online_{epochs}_epochs'] = score(y_test, online.predict(X_test))
+
+    if not silent:
+        print(results)
+
+    return results
+
+
+###########################
+# Model Compression
+###########################
+
+class CompressedSVM:
+    # RBF expansion over a reduced set of support vectors:
+    # f(x) = sum_j coef_j * exp(-gamma * |x - c_j|^2) + intercept
+
+    def __init__(self, centers, coef, intercept, gamma, classes=None):
+        self.centers = centers
+        self.coef = coef
+        self.intercept = intercept
+        self.gamma = gamma
+        self.classes = classes
+
+    @property
+    def n_support(self):
+        return self.centers.shape[0]
+
+    def decision_function(self, X):
+        from sklearn.metrics.pairwise import rbf_kernel
+        return rbf_kernel(X, self.centers, gamma=self.gamma) @ self.coef + self.intercept
+
+    def predict(self, X):
+        d = self.decision_function(X)
+        if self.classes is None:
+            return d
+        return self.classes[(d > 0).astype(int)]
+
+
+def compress_svm(svm, X, budget, ridge=1e-8):
+    # Keeps the 'budget' support vectors with the largest |dual coef| and refits
+    # their coefficients (least squares) to reproduce the decision function on X.
+    # X should be the data the model was fit on (the kernel gamma is the fitted one)
+    from sklearn.metrics.pairwise import rbf_kernel
+
+    assert svm.kernel == 'rbf', 'Only RBF models can be compressed'
+    # Resolved value of gamma='scale'/'auto' at fit time (private sklearn attribute,
+    # but the only place where the fitted value is kept)
+    gamma = svm._gamma
+    classes = getattr(svm, 'classes_', None)
+    assert classes is None or len(classes) == 2, 'Only binary classifiers are supported'
+
+    sv = svm.support_vectors_
+    dual = svm.dual_coef_.ravel()
+    intercept = svm.intercept_[0]
+
+    if budget >= sv.shape[0]:
+        return CompressedSVM(sv, dual, intercept, gamma, classes)
+
+    keep = np.argsort(-np.abs(dual))[:budget]
+    centers = sv[keep]
+
+    decision = svm.predict(X) if classes is None else svm.decision_function(X)
+    target = decision - intercept
+    K = rbf_kernel(X, centers, gamma=gamma)
+    coef = np.linalg.solve(K.T @ K + ridge * np.eye(budget), K.T @ target)
+
+    return CompressedSVM(centers, coef, intercept, gamma, classes)
+
+
+def time_predictions(models, X, repeats=7):
+    # Best-of-repeats prediction time of each model, with the models interleaved
+    # in every repeat so that they all see the same machine load
+    from time import perf_counter
+    best = np.full(len(models), np.inf)
+    for _ in range(repeats):
+        for i, model in enumerate(models):
+            t = perf_counter()
+            model.predict(X)
+            best[i] = min(best[i], perf_counter() - t)
+    return best
+
+
+def test_svm_compression(X, y, regression=False, budgets=(5, 10, 20, 50, 100), seed=None, silent=False):
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.33, random_state=seed)
+
+    if regression:
+        svm = SVR()
+        svm.epsilon = 0.0841395
+        svm.C = 0.122
+        score = r2_score
+    else:
+        X_train, y_train = balance_dataset(X_train, y_train)
+        svm = SVC()
+        score = accuracy_score
+
+    svm.fit(X_train, y_train)
+
+    # Large enough batch for stable timings
+    X_bench = np.tile(X_test, (max(1, 10_000 // X_test.shape[0]), 1))
+    n_sv = svm.support_vectors_.shape[0]
+    score_full = score(y_test, svm.predict(X_test))
+
+    budgets = sorted(b for b in budgets if b < n_sv) + [n_sv]
+    compressed = [compress_svm(svm, X_train, budget) for budget in budgets]
+
+    # The full expansion (budget=n_sv) uses the same implementation as the compressed
+    # models, so that 'speedup' only reflects the SV count. 'speedup_sklearn' is
+    # measured against svm.predict on the same batch.
+    times = time_predictions([svm] + compressed, X_bench)
+    time_sklearn, time_full = times[0], times[-1]
+
+    results = []
+    for budget, model, t in zip(budgets, compressed, times[1:]):
+        results.append({
+            'budget': budget,
+            'n_support': model.n_support,
+            'score_test': score(y_test, model.predict(X_test)),
+            'score_test_full': score_full,
+            'speedup': time_full / t,
+            'speedup_sklearn': time_sklearn / t
+        })
+
+    results = pd.DataFrame(results)
+
+    if not silent:
+        print(f'Support vectors (full model): {n_sv} / {X_train.shape[0]}')
+        print(results)
+
+    return results
+
+
+def plot_compression(x, output_path=None):
+    plt.figure()
+    plt.subplot(2,1,1)
+    plt.plot(x['n_support'], x['score_test'], marker='^')
+    plt.axhline(x['score_test_full'].iloc[0], linestyle='--')
+    plt.ylabel('Score (validation)')
+    plt.subplot(2,1,2)
+    plt.plot(x['n_support'], x['speedup'], marker='^')
+    plt.xlabel('Support vectors')
+    plt.ylabel('Prediction speedup')
+    if output_path is not None:
+        plt.savefig(output_path, bbox_inches='tight')
+    plt.show()
+
+
 ###########################
 # Parameters Search
 ###########################
@@ -425,32 +939,20 @@ def get_configs(n, min_eps, max_eps, min_c, max_c):
     return configs
 
 
-def params_search(X, y, configs, trials_per_config):
-
-    all_results = []
-    seed = 42
-
-    for config in configs:
-        eps, c = config.values()
-        config_results = [test_energy_model(X, y, epsilon=eps, C=c, seed=(seed+i), silent=True) for i in range(trials_per_config)]
-        config_results = pd.DataFrame(config_results)
-        all_results.append({
-            'config': config,
-            'results': config_results
-        })
-
-    all_results = pd.DataFrame(all_results)
+def eval_config(X, y, config, trials_per_config, seed=42):
+    eps, c = config.values()
+    config_results = [test_energy_model(X, y, epsilon=eps, C=c, seed=(seed+i), silent=True) for i in range(trials_per_config)]
+    score_test = np.array(pd.DataFrame(config_results)['score_test'])
+    return {
+        **config,
+        'score_test_min': score_test.min(),
+        'score_test_max': score_test.max(),
+        'score_test_avg': score_test.mean()
+    }
 
-    scores_only = []
-    for i, res in enumerate(all_results['results']):
-        score_test = np.array(res['score_test'])
-        scores_only.append({
-            **configs[i],
-            'score_test_min': score_test.min(),
-            'score_test_max': score_test.max(),
-            'score_test_avg': score_test.mean()
-        })
 
+def params_search(X, y, configs, trials_per_config):
+    scores_only = [eval_config(X, y, config, trials_per_config) for config in configs]
     scores_only = pd.DataFrame(scores_only)
     return scores_only
 
@@ -509,29 +1011,17 @@ def plot_search(x, output_path=None):
 
 
 
-def params_search_cv(X, y, configs, cv=5):
-
-    all_results = []
-
-    for config in configs:
-        eps, c = config.values()
-        config_results = test_energy_model_cv(X, y, epsilon=eps, C=c, cv=cv, silent=True)
-        # config_results = pd.DataFrame(config_results)
-        all_results.append({
-            'config': config,
-            'results': config_results
-        })
-
-    all_results = pd.DataFrame(all_results)
+def eval_config_cv(X, y, config, cv=5):
+    eps, c = config.values()
+    config_results = test_energy_model_cv(X, y, epsilon=eps, C=c, cv=cv, silent=True)
+    return {
+        **config,
+        **config_results
+    }
 
-    r2s = []
-    for i, res in enumerate(all_results['results']):
-        # cv_r2 = np.array(res['cv_r2'])
-        r2s.append({
-            **configs[i],
-            **res
-        })
 
+def params_search_cv(X, y, configs, cv=5):
+    r2s = [eval_config_cv(X, y, config, cv=cv) for config in configs]
     r2s = pd.DataFrame(r2s)
     return r2s
 
@@ -659,6 +1149,197 @@ def test_search():
     # test_energy_model_avg(X_alexa, y_alexa)
 
 
+###########################
+# Distributed Search
+###########################
+
+# Job table shared by the coordinator and by any number of workers (on any node).
+# A job whose lease expires (crashed/killed worker) goes back to the queue,
+# until it has been attempted SEARCH_MAX_ATTEMPTS times.
+SEARCH_LEASE = 15 * 60.0
+SEARCH_MAX_ATTEMPTS = 3
+SEARCH_POLL_INTERVAL = 5.0
+
+
+def open_search_db(db_path, create=False):
+    # Workers open the queue read-write only, so that they never create an empty DB
+    # in place of the one the coordinator is still building
+    import sqlite3
+    mode = 'rwc' if create else 'rw'
+    conn = sqlite3.connect(f'{Path(db_path).absolute().as_uri()}?mode={mode}', uri=True,
+                           timeout=60.0, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout = 60000')
+    return conn
+
+
+def create_search_queue(db_path, X, y, configs, trials_per_config=None, cv=5):
+    # trials_per_config=None -> params_search_cv, otherwise params_search
+    # The queue is built under a temporary name and renamed into place once complete,
+    # so that workers never see a half-built queue
+    import pickle
+    from os import getpid, replace
+
+    assert not Path(db_path).is_file(), 'Search queue already exists'
+    tmp_path = f'{db_path}.{getpid()}.tmp'
+    conn = open_search_db(tmp_path, create=True)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value BLOB)')
+        conn.execute('''
+            CREATE TABLE jobs (
+                id INTEGER PRIMARY KEY,
+                config TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                result BLOB
+            )''')
+        conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('data', pickle.dumps((X, y))),
+            ('params', pickle.dumps({'trials_per_config': trials_per_config, 'cv': cv}))
+        ])
+        conn.executemany('INSERT INTO jobs (id, config) VALUES (?, ?)',
+                         [(i, json.dumps(config)) for i, config in enumerate(configs)])
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        conn.close()
+        remove(tmp_path)
+        raise
+    conn.close()
+    replace(tmp_path, db_path)
+
+
+def expire_search_leases(conn, now, max_attempts=SEARCH_MAX_ATTEMPTS):
+    # Jobs whose worker died on their last attempt will never be claimed again
+    conn.execute('''
+        UPDATE jobs SET status = 'failed', error = COALESCE(error, 'Lease expired')
+        WHERE status = 'running' AND lease_expires < ? AND attempts >= ?''', (now, max_attempts))
+
+
+def claim_search_job(conn, worker_id, lease=SEARCH_LEASE, max_attempts=SEARCH_MAX_ATTEMPTS):
+    from time import time
+    now = time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        expire_search_leases(conn, now, max_attempts)
+        row = conn.execute('''
+            SELECT id, config FROM jobs
+            WHERE (status = 'pending' OR (status = 'running' AND lease_expires < ?))
+              AND attempts < ?
+            ORDER BY id LIMIT 1''', (now, max_attempts)).fetchone()
+        if row is not None:
+            conn.execute('''
+                UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE id = ?''', (worker_id, now + lease, row[0]))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return None if row is None else (row[0], json.loads(row[1]))
+
+
+def search_queue_status(db_path, max_attempts=SEARCH_MAX_ATTEMPTS):
+    # Expired leases are not reported as 'running': they are either
+    # back to 'pending' (to be retried) or 'failed' (no attempts left)
+    from time import time
+    now = time()
+    conn = open_search_db(db_path)
+    expire_search_leases(conn, now, max_attempts)
+    counts = dict(conn.execute('''
+        SELECT CASE WHEN status = 'running' AND lease_expires < ? THEN 'pending' ELSE status END AS s, COUNT(*)
+        FROM jobs GROUP BY s''', (now,)).fetchall())
+    conn.close()
+    return counts
+
+
+def run_search_worker(db_path, worker_id=None, lease=SEARCH_LEASE, max_attempts=SEARCH_MAX_ATTEMPTS,
+                      poll_interval=SEARCH_POLL_INTERVAL):
+    import pickle
+    import socket
+    import traceback
+    from os import getpid
+    from time import sleep
+
+    if worker_id is None:
+        worker_id = f'{socket.gethostname()}:{getpid()}'
+
+    conn = open_search_db(db_path)
+    meta = dict(conn.execute('SELECT key, value FROM meta').fetchall())
+    X, y = pickle.loads(meta['data'])
+    params = pickle.loads(meta['params'])
+    n_done = 0
+
+    while True:
+        job = claim_search_job(conn, worker_id, lease=lease, max_attempts=max_attempts)
+
+        if job is None:
+            # Jobs still leased by other workers may come back if those crash
+            running = conn.execute('''
+                SELECT COUNT(*) FROM jobs WHERE status = 'running' AND attempts < ?''',
+                (max_attempts,)).fetchone()[0]
+            if running == 0:
+                break
+            sleep(poll_interval)
+            continue
+
+        job_id, config = job
+        try:
+            if params['trials_per_config'] is None:
+                res = eval_config_cv(X, y, config, cv=params['cv'])
+            else:
+                res = eval_config(X, y, config, params['trials_per_config'])
+        except Exception:
+            conn.execute('''
+                UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, error = ?
+                WHERE id = ? AND worker = ? AND status = 'running' ''',
+                (max_attempts, traceback.format_exc(), job_id, worker_id))
+            continue
+
+        # Only commit if the lease was not taken over by another worker meanwhile
+        conn.execute('''
+            UPDATE jobs SET status = 'done', result = ?, error = NULL
+            WHERE id = ? AND worker = ? AND status = 'running' ''',
+            (pickle.dumps(res), job_id, worker_id))
+        n_done += 1
+
+    conn.close()
+    return n_done
+
+
+def collect_search_results(db_path):
+    import pickle
+    conn = open_search_db(db_path)
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+    rows = conn.execute("SELECT result FROM jobs WHERE status = 'done' ORDER BY id").fetchall()
+    conn.close()
+    assert set(counts) <= {'done'}, f'Search not complete: {counts}'
+    return pd.DataFrame([pickle.loads(r[0]) for r in rows])
+
+
+def params_search_distributed(X, y, configs, db_path, trials_per_config=None, cv=5,
+                              n_local_workers=1, poll_interval=SEARCH_POLL_INTERVAL):
+    # Workers on other nodes join with: python main.py worker <db_path>
+    from concurrent.futures import ProcessPoolExecutor
+    from time import sleep
+
+    create_search_queue(db_path, X, y, configs, trials_per_config=trials_per_config, cv=cv)
+
+    if n_local_workers > 0:
+        with ProcessPoolExecutor(max_workers=n_local_workers) as executor:
+            list(executor.map(run_search_worker, [db_path] * n_local_workers))
+
+    while True:
+        counts = search_queue_status(db_path)
+        if counts.get('pending', 0) == 0 and counts.get('running', 0) == 0:
+            break
+        sleep(poll_interval)
+
+    return collect_search_results(db_path)
+
+
 ###########################
 # Main
 ###########################
@@ -729,4 +1410,8 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    import sys
+    if len(sys.argv) == 3 and sys.argv[1] == 'worker':
+        run_search_worker(sys.argv[2])
+    else:
+        main()